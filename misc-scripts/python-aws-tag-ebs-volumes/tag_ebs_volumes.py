@@ -1,8 +1,18 @@
 import argparse
 import boto3
+from botocore.config import Config
 import os
 import fnmatch
-from typing import Dict, List, Set
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+# The maximum number of resource IDs to send in a single describe call
+DESCRIBE_BATCH_SIZE = 200
+# The maximum number of describe calls to run concurrently
+MAX_WORKERS = 20
+# The maximum number of resource IDs to send in a single create_tags call
+CREATE_TAGS_BATCH_SIZE = 1000
 
 
 def main():
@@ -23,7 +33,7 @@ def main():
     if opts.file:
         ebs_volume_id_file = get_full_path_to(opts.file)
         with open(ebs_volume_id_file, "r") as _f:
-            ebs_volume_ids.append(_f.read().splitlines())
+            ebs_volume_ids.extend(line.strip() for line in _f if line.strip())
 
     print("Using the following as script input:")
     print(f"  - AWS Profile: {aws_profile}")
@@ -35,11 +45,10 @@ def main():
         print("\nYou have chosen to stop the script.")
         exit()
 
-    ec2_resource, ec2_client = connect_to_aws(aws_profile, aws_region)
+    ec2_client = connect_to_aws(aws_profile, aws_region, verbose=opts.verbose)
 
     print(" \nBegin tagging EC2 volumes!")
     start_tagging_volumes(
-        ec2_resource,
         ec2_client,
         ebs_volume_ids,
         instance_ids,
@@ -66,36 +75,53 @@ def get_full_path_to(input_path):
         raise FileNotFoundError
 
 
-def connect_to_aws(aws_profile, aws_region):
+def connect_to_aws(aws_profile, aws_region, verbose=False):
     print("\nConnecting into AWS...")
     try:
         aws_session = boto3.Session(profile_name=aws_profile, region_name=aws_region)
-        client = aws_session.client("sts")
-        caller_arn = client.get_caller_identity()["Arn"]
+        # The caller identity is only needed for the verbose output, so skip the
+        # extra STS round-trip otherwise
+        if verbose:
+            client = aws_session.client("sts")
+            caller_arn = client.get_caller_identity()["Arn"]
     except Exception as e:
         print(e)
         exit(1)
 
-    print(f"Successfully connected into AWS using - {caller_arn}")
-    ec2_resource = aws_session.resource("ec2", region_name=aws_region)
-    ec2_client = aws_session.client("ec2", region_name=aws_region)
+    if verbose:
+        print(f"Successfully connected into AWS using - {caller_arn}")
+    # Allow enough pooled connections for the concurrent describe calls and keep
+    # idle connections alive so they can be reused without a new TLS handshake.
+    # The adaptive retry mode paces the calls to the API rate limit when throttled.
+    # Client side parameter validation is skipped as the requests are built by this
+    # script, malformed input such as a bad ID is reported by the EC2 API instead
+    config = Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": 10},
+        parameter_validation=False,
+    )
+    ec2_client = aws_session.client("ec2", region_name=aws_region, config=config)
 
-    return ec2_resource, ec2_client
+    return ec2_client
 
 
-def filter_tags(tags: Dict[str, str], filter_tags: List[str]) -> Dict[str, str]:
+def get_tag_matcher(filter_tags: List[str]) -> Callable[[str], bool]:
     """
-    Filter the tags based on the filter_tags list
+    Compile the filter_tags wildcard patterns into a single regex matcher
     """
-    return {
-        key: value
-        for key, value in tags.items()
-        if any(fnmatch.fnmatch(key, tag) for tag in filter_tags)
-    }
+    pattern = "|".join(f"(?:{fnmatch.translate(tag)})" for tag in filter_tags)
+    return re.compile(pattern).fullmatch
+
+
+def filter_tags(tags: Dict[str, str], matcher: Callable[[str], bool]) -> Dict[str, str]:
+    """
+    Filter the tags based on the tag matcher
+    """
+    return {key: value for key, value in tags.items() if matcher(key)}
 
 
 def start_tagging_volumes(
-    ec2_resource,
     ec2_client,
     ebs_volume_ids,
     instance_ids,
@@ -107,82 +133,105 @@ def start_tagging_volumes(
     # tags_by_instance is a dictionary which contains the instance ID as the key and the tags as the value
     tags_by_instance: Dict[str, Dict[str:str]] = dict()
     volumes_by_instance: Dict[str, Set[str]] = dict()
+    # tags_by_volume caches the tags of every volume described so far
+    tags_by_volume: Dict[str, Dict[str, str]] = dict()
+    tag_matcher = get_tag_matcher(tags) if tags else None
+    instance_ids = set(instance_ids)
+    ebs_volume_ids = set(ebs_volume_ids)
 
-    # iterate over the supplied instances and get the tags and their volumes
+    # describe all the supplied instances in batches and get their tags and volumes
     found_volumes: Set[str] = set()
-    for instance_id in set(instance_ids):
-        tags_by_instance[instance_id] = get_resource_tags(
-            ec2_client, "instance", instance_id
-        )
+    for instance in describe_instances(ec2_client, instance_ids):
+        instance_id = instance["InstanceId"]
+        tags_by_instance[instance_id] = tags_to_dict(instance.get("Tags", []))
         volumes_by_instance[instance_id] = set(
-            get_instance_volumes(ec2_resource, instance_id, verbose=verbose)
+            get_instance_volumes(instance, verbose=verbose)
         )
         found_volumes.update(volumes_by_instance[instance_id])
 
-    # iterate over the supplied volumes and find the attached instance
-    for vol_id in set(ebs_volume_ids):
-        if vol_id in found_volumes:
-            continue
-        ebs_volume = ec2_resource.Volume(vol_id)
-        if ebs_volume.state == "available":
-            # The volume status is 'available', therefore it is not attached to anything
+    # describe the remaining supplied volumes in batches and find the attached instance
+    orphan_volume_ids = ebs_volume_ids - found_volumes
+    for volume in describe_volumes(ec2_client, orphan_volume_ids):
+        vol_id = volume["VolumeId"]
+        tags_by_volume[vol_id] = tags_to_dict(volume.get("Tags", []))
+        if not volume.get("Attachments"):
+            # The volume has no attachments, e.g. its status is 'available'
             print(f"Volume ID [{vol_id}] has no attachments")
             print("Skipped tagging this volume")
             continue
-        instance_id = ebs_volume.attachments[0].get("InstanceId")
-        if instance_id not in tags_by_instance:
-            tags_by_instance[instance_id] = get_resource_tags(
-                ec2_client, "instance", instance_id, verbose=verbose
-            )
-            volumes_by_instance[instance_id] = set([vol_id])
-            found_volumes.add(vol_id)
+        instance_id = volume["Attachments"][0].get("InstanceId")
+        volumes_by_instance.setdefault(instance_id, set()).add(vol_id)
+        found_volumes.add(vol_id)
+
+    # describe all the instances found via their volumes in a single batched pass
+    # and get their tags
+    for instance in describe_instances(
+        ec2_client, volumes_by_instance.keys() - tags_by_instance.keys()
+    ):
+        tags_by_instance[instance["InstanceId"]] = tags_to_dict(
+            instance.get("Tags", [])
+        )
+
+    # filter the instance tags up front, so that the volumes of instances without
+    # any tags to propagate are not described at all
+    if tags:
+        filtered_tags_by_instance = {
+            instance_id: filter_tags(tags_on_instance, tag_matcher)
+            for instance_id, tags_on_instance in tags_by_instance.items()
+        }
+    else:
+        filtered_tags_by_instance = tags_by_instance
+
+    # describe the volumes to be tagged which are not cached yet and get their tags
+    volumes_to_tag = set().union(
+        *(
+            volumes
+            for instance_id, volumes in volumes_by_instance.items()
+            if filtered_tags_by_instance[instance_id]
+        )
+    )
+    for volume in describe_volumes(ec2_client, volumes_to_tag - tags_by_volume.keys()):
+        tags_by_volume[volume["VolumeId"]] = tags_to_dict(volume.get("Tags", []))
 
     # now, iterate over instances
     for instance_id, volumes in volumes_by_instance.items():
-        tags_on_instance = tags_by_instance[instance_id]
-        instance_name = tags_on_instance.get("Name", "N/A")
-        if tags:
-            tags_on_instance = filter_tags(tags_on_instance, tags)
+        instance_name = tags_by_instance[instance_id].get("Name", "N/A")
+        tags_on_instance = filtered_tags_by_instance[instance_id]
 
         print("================================================================")
         print(f"Processing instance [{instance_id}], Name: {instance_name!r}")
         print(f"Instance tags{" (filtered)" if tags else ""}: {tags_on_instance}")
+        if not tags_on_instance:
+            print("No applicable tags on this instance, skipping its volumes")
+            continue
         print(f"Processing volumes: {volumes}")
 
+        # volumes_by_tags groups the volumes by the tags to apply, so that each
+        # distinct set of tags is applied with a single create_tags call
+        volumes_by_tags: Dict[Tuple[Tuple[str, str], ...], List[str]] = dict()
+        # freeze the instance tags once, they are compared against every volume
+        instance_tag_items = tuple(tags_on_instance.items())
+        instance_tag_keys = frozenset(tags_on_instance)
         for volume_id in volumes:
             print("--------------------------------")
-            ebs_volume = ec2_resource.Volume(volume_id)
-            tags_on_volume = tags_to_dict(ebs_volume.tags)
+            tags_on_volume = tags_by_volume[volume_id]
             volume_name = tags_on_volume.get("Name", "N/A")
             if tags:
-                tags_on_volume = filter_tags(tags_on_volume, tags)
+                tags_on_volume = filter_tags(tags_on_volume, tag_matcher)
             print(f"Processing volume [{volume_id}], Name: {volume_name!r}")
 
-            new_tags = {
-                key: value
-                for key, value in tags_on_instance.items()
-                if key not in tags_on_volume
-            }
-            same_tags = {
-                key: value
-                for key, value in tags_on_instance.items()
-                if key in tags_on_volume and tags_on_volume[key] == value
-            }
-            differing_tags = {
-                key: value
-                for key, value in tags_on_instance.items()
-                if key in tags_on_volume and tags_on_volume[key] != value
-            }
-            differing_tags_on_volume = {
-                key: value
-                for key, value in tags_on_volume.items()
-                if key in differing_tags
-            }
-            missing_tags = {
-                key: value
-                for key, value in tags_on_volume.items()
-                if key not in tags_on_instance
-            }
+            # classify the instance tags in a single pass, identical tags are
+            # only collected when they are going to be printed
+            new_tags = dict()
+            same_tags = dict()
+            differing_tags = dict()
+            for key, value in instance_tag_items:
+                if key not in tags_on_volume:
+                    new_tags[key] = value
+                elif tags_on_volume[key] != value:
+                    differing_tags[key] = value
+                elif verbose:
+                    same_tags[key] = value
 
             if overwrite:
                 tags_to_apply = {**new_tags, **differing_tags}
@@ -190,6 +239,16 @@ def start_tagging_volumes(
                 tags_to_apply = new_tags
 
             if verbose:
+                differing_tags_on_volume = {
+                    key: value
+                    for key, value in tags_on_volume.items()
+                    if key in differing_tags
+                }
+                missing_tags = {
+                    key: value
+                    for key, value in tags_on_volume.items()
+                    if key not in instance_tag_keys
+                }
                 if same_tags:
                     print(f"Found identical tags: {same_tags}")
                 if missing_tags:
@@ -208,13 +267,23 @@ def start_tagging_volumes(
                 print("No tags to apply")
                 continue
 
-            if not dry_run:
-                print(f"Tagging volume with the following tags: {tags_to_apply}")
-                ec2_client.create_tags(
-                    Resources=[volume_id], Tags=dict_to_tags(tags_to_apply)
-                )
-            else:
-                print(f"Dry run, not tagging volume with tags: {tags_to_apply}")
+            tag_set = tuple(sorted(tags_to_apply.items()))
+            volumes_by_tags.setdefault(tag_set, list()).append(volume_id)
+
+        for tag_set, volume_ids in volumes_by_tags.items():
+            tags_to_apply = dict(tag_set)
+            for batch in batched(volume_ids, CREATE_TAGS_BATCH_SIZE):
+                if not dry_run:
+                    print(
+                        f"Tagging volumes {batch} with the following tags: {tags_to_apply}"
+                    )
+                    ec2_client.create_tags(
+                        Resources=batch, Tags=dict_to_tags(tags_to_apply)
+                    )
+                else:
+                    print(
+                        f"Dry run, not tagging volumes {batch} with tags: {tags_to_apply}"
+                    )
 
 
 def tags_to_dict(tags):
@@ -225,28 +294,69 @@ def dict_to_tags(tags):
     return [{"Key": key, "Value": value} for key, value in tags.items()]
 
 
-def get_resource_tags(
-    ec2_client, resource_type: str, resource_id: str, verbose: bool = False
-) -> Dict[str, str]:
-    instance_tags = ec2_client.describe_tags(
-        Filters=[{"Name": "resource-id", "Values": [resource_id]}]
-    )["Tags"]
+def batched(
+    items: Iterable[str], size: int = DESCRIBE_BATCH_SIZE
+) -> Iterator[List[str]]:
+    """
+    Split the items into lists of at most size items
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
 
-    tags = tags_to_dict(instance_tags)
-    if verbose:
-        print(
-            f"The {resource_type} [{resource_id}] contains the following tags: {tags}"
-        )
 
-    return tags
+def map_batches(
+    function: Callable[[List[str]], List[dict]], items: Iterable[str]
+) -> Iterator[dict]:
+    """
+    Call the function concurrently on batches of the items and yield the results
+    of each batch as soon as it is done
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for results in executor.map(function, batched(items)):
+            yield from results
+
+
+def describe_instances(ec2_client, instance_ids: Iterable[str]) -> Iterator[dict]:
+    """
+    Describe the instances in batches and yield the instance descriptions
+    """
+    paginator = ec2_client.get_paginator("describe_instances")
+
+    def describe_batch(batch: List[str]) -> List[dict]:
+        return [
+            instance
+            for page in paginator.paginate(InstanceIds=batch)
+            for reservation in page["Reservations"]
+            for instance in reservation["Instances"]
+        ]
+
+    return map_batches(describe_batch, instance_ids)
+
+
+def describe_volumes(ec2_client, volume_ids: Iterable[str]) -> Iterator[dict]:
+    """
+    Describe the volumes in batches and yield the volume descriptions
+    """
+    paginator = ec2_client.get_paginator("describe_volumes")
+
+    def describe_batch(batch: List[str]) -> List[dict]:
+        return [
+            volume
+            for page in paginator.paginate(VolumeIds=batch)
+            for volume in page["Volumes"]
+        ]
 
+    return map_batches(describe_batch, volume_ids)
 
-def get_instance_volumes(ec2_resource, instance_id: str, verbose=True) -> List[str]:
-    instance = ec2_resource.Instance(instance_id)
-    volumes = list()
 
-    for volume in instance.volumes.all():
-        volumes.append(volume.id)
+def get_instance_volumes(instance: dict, verbose=True) -> List[str]:
+    instance_id = instance["InstanceId"]
+    volumes = [
+        mapping["Ebs"]["VolumeId"]
+        for mapping in instance.get("BlockDeviceMappings", [])
+        if "Ebs" in mapping
+    ]
 
     if verbose:
         print(f"Adding volumes {volumes} from instance {instance_id}")